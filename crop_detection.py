@@ -1,23 +1,133 @@
 """Crop detection service logic."""
-import json
-from typing import Optional
-from pydantic import ValidationError
+import asyncio
+import hashlib
+from typing import Any, AsyncIterator, Callable, Dict, Final, List, Optional, \
+    Tuple
+from openai import LengthFinishReasonError
 from logger_config import setup_logger
-from models import CropDetectionResponse, CropBasicInfo, DiseaseInfo, \
-    TreatmentRecommendation
-from openai_client import OpenAIClient
+from models import CropDetectionBatchResponse, CropDetectionResponse, \
+    CropImageCheck
+from micro_batcher import MicroBatcher
+from openai_client import HTTP_TIMEOUT, OpenAIClient
+from response_cache import ResponseCache, CACHE_MODE_REPLAY
+from variables import get_config
 
 logger = setup_logger(__name__)
 
+# Detection prompt, built once at import time
+_DETECTION_PROMPT: Final[str] = """
+Analyze the uploaded image and determine the following:
+
+1. Is this image related to crops or agriculture?
+2. If yes, identify the basic information about the crop:
+   - Crop name
+   - Crop type
+   - Growth stage (if visible)
+   - Overall health status
+
+3. Detect any diseases present on the crop:
+   - Disease name
+   - Confidence level of detection
+
+4. Provide recommendations to save the crop:
+   - Immediate actions needed
+   - Preventive measures
+   - Treatment methods (both chemical and organic)
+   - Best practices
+
+Please provide a comprehensive analysis in JSON format with the
+following structure:
+{
+    "is_crop_image": boolean,
+    "crop_info": {
+        "crop_name": string,
+        "crop_type": string,
+        "growth_stage": string,
+        "health_status": string
+    },
+    "diseases": [
+        {
+            "disease_name": string,
+            "affected_areas": [string]
+        }
+    ],
+    "recommendations": {
+        "immediate_actions": [string],
+        "preventive_measures": [string],
+        "treatment_methods": [string],
+        "chemical_treatments": [string],
+        "organic_treatments": [string]
+    },
+    "analysis_summary": string,
+}
+
+If the image is not crop-related, set "is_crop_image" to false and
+provide an explanation in "analysis_summary".
+"""
+
+# Short hash of the prompt; part of the cache key so edits invalidate it
+_PROMPT_VERSION: Final[str] = hashlib.sha256(
+    _DETECTION_PROMPT.encode("utf-8")
+).hexdigest()[:8]
+
+# Prompt and token budget for the quick crop check run before a full
+# analysis; a low-detail image keeps the request small
+_CROP_CHECK_PROMPT: Final[str] = (
+    "Does this image show crops, plants or agriculture? Set "
+    '"is_crop_image" accordingly.'
+)
+_CROP_CHECK_MAX_TOKENS = 20
+
+# Completion token budget for each image in a request, and the larger
+# budget used to retry a single image whose response was truncated
+_MAX_TOKENS_PER_IMAGE = 1200
+_RETRY_MAX_TOKENS = 2000
+_TOKEN_BUDGETS = (_MAX_TOKENS_PER_IMAGE, _RETRY_MAX_TOKENS)
+
+
+def _read_timeout(max_tokens: int) -> float:
+    """
+    Scale the pool's read timeout to a non-streamed call's token budget.
+
+    A non-streamed completion sends nothing until it is finished, so the
+    pool's timeout, sized for one image's budget, grows with max_tokens.
+
+    Args:
+        max_tokens: Completion token limit of the call.
+
+    Returns:
+        Read timeout in seconds.
+    """
+    return HTTP_TIMEOUT.read * max_tokens / _MAX_TOKENS_PER_IMAGE
+
 
 class CropDetectionService:
     """Service class for crop disease detection."""
 
     def __init__(self):
         """Initialize crop detection service."""
+        config = get_config()
         self.openai_client = OpenAIClient()
+        self.response_cache = ResponseCache(
+            config.cache_mode, config.cache_max_entries,
+            config.cache_ttl_seconds
+        )
+        self._batcher = MicroBatcher(
+            batch_fn=self._analyze_batch,
+            single_fn=self._analyze_single,
+            max_batch_size=config.batch_max_size,
+            window_seconds=config.batch_window_ms / 1000,
+            batch_timeout_seconds=config.batch_timeout_seconds
+        )
+        # Detections currently running upstream, keyed by cache key
+        self._inflight: Dict[str, asyncio.Task] = {}
         logger.info("CropDetectionService initialized")
 
+    async def close(self) -> None:
+        """Release resources held by the service."""
+        await self._batcher.close()
+        await self.openai_client.close()
+
     def _create_detection_prompt(self) -> str:
         """
         Create prompt for crop detection and analysis.
@@ -25,173 +135,264 @@ class CropDetectionService:
         Returns:
             Formatted prompt string.
         """
-        prompt = """
-        Analyze the uploaded image and determine the following:
+        return _DETECTION_PROMPT
 
-        1. Is this image related to crops or agriculture?
-        2. If yes, identify the basic information about the crop:
-           - Crop name
-           - Crop type
-           - Growth stage (if visible)
-           - Overall health status
+    def _create_batch_prompt(self, image_count: int) -> str:
+        """
+        Create prompt for analyzing several images in one request.
 
-        3. Detect any diseases present on the crop:
-           - Disease name
-           - Confidence level of detection
+        Args:
+            image_count: Number of images attached to the request.
 
-        4. Provide recommendations to save the crop:
-           - Immediate actions needed
-           - Preventive measures
-           - Treatment methods (both chemical and organic)
-           - Best practices
+        Returns:
+            Formatted prompt string.
+        """
+        return f"""
+        You will receive {image_count} images, labelled "Image 1" to
+        "Image {image_count}". Analyze each image independently using the
+        instructions below, then respond with a single JSON object of the
+        form {{"results": [<analysis of Image 1>, ..., <analysis of
+        Image {image_count}>]}} containing exactly {image_count} entries in
+        image order.
+        {self._create_detection_prompt()}
+        """
 
-        Please provide a comprehensive analysis in JSON format with the
-        following structure:
-        {
-            "is_crop_image": boolean,
-            "crop_info": {
-                "crop_name": string,
-                "crop_type": string,
-                "growth_stage": string,
-                "health_status": string
-            },
-            "diseases": [
-                {
-                    "disease_name": string,
-                    "affected_areas": [string]
-                }
-            ],
-            "recommendations": {
-                "immediate_actions": [string],
-                "preventive_measures": [string],
-                "treatment_methods": [string],
-                "chemical_treatments": [string],
-                "organic_treatments": [string]
-            },
-            "analysis_summary": string,
-        }
+    def _normalize_response(
+        self, response: CropDetectionResponse
+    ) -> CropDetectionResponse:
+        """
+        Drop crop details from responses for non-crop images.
 
-        If the image is not crop-related, set "is_crop_image" to false and
-        provide an explanation in "analysis_summary".
+        Args:
+            response: Parsed response from OpenAI.
+
+        Returns:
+            The response, reduced to its summary if the image is not a crop.
         """
-        return prompt
+        if response.is_crop_image:
+            return response
 
-    def _parse_openai_response(
-        self, response_text: str
-    ) -> Optional[dict]:
+        logger.info("Image is not crop-related")
+        return CropDetectionResponse(
+            is_crop_image=False,
+            analysis_summary=response.analysis_summary
+        )
+
+    def _prepare(
+        self, image_data_url: str, image_digest: Optional[str]
+    ) -> Tuple[str, Optional[CropDetectionResponse]]:
         """
-        Parse OpenAI response text to extract JSON.
+        Validate a detection request and look up its cached analysis.
 
         Args:
-            response_text: Raw response text from OpenAI.
+            image_data_url: Base64 JPEG data URL.
+            image_digest: SHA256 hex digest of the image bytes. Computed
+                from the data URL when not provided.
 
         Returns:
-            Parsed JSON dictionary or None if parsing fails.
+            Cache key for the image, and the cached response or None if
+            the upstream API should be called.
+
+        Raises:
+            ValueError: If the image data is empty, or on a cache miss in
+                replay mode.
         """
-        try:
-            # Try to extract JSON from markdown code blocks
-            if "```json" in response_text:
-                start = response_text.find("```json") + 7
-                end = response_text.find("```", start)
-                json_str = response_text[start:end].strip()
-            elif "```" in response_text:
-                start = response_text.find("```") + 3
-                end = response_text.find("```", start)
-                json_str = response_text[start:end].strip()
-            else:
-                json_str = response_text.strip()
+        if not image_data_url:
+            logger.error("Empty image data provided")
+            raise ValueError("Image data cannot be empty")
+
+        if image_digest is None:
+            image_digest = hashlib.sha256(
+                image_data_url.encode("ascii")
+            ).hexdigest()
+        cache_key = self._build_cache_key(image_digest)
+
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("Returning cached crop disease analysis")
+            return cache_key, CropDetectionResponse.model_validate_json(
+                cached_response
+            )
 
-            # Remove leading/trailing whitespace and newlines
-            json_str = json_str.strip()
+        if self.response_cache.mode == CACHE_MODE_REPLAY:
+            logger.error("Cache miss in replay mode")
+            raise ValueError(
+                "No cached analysis available for this image "
+                "(cache is in replay mode)"
+            )
+        return cache_key, None
 
-            parsed_data = json.loads(json_str)
-            logger.info("Successfully parsed OpenAI response")
-            return parsed_data
+    def _finish(
+        self, response: Optional[CropDetectionResponse], cache_key: str
+    ) -> CropDetectionResponse:
+        """
+        Normalize and cache the analysis of an upstream detection.
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON from response: {str(e)}")
-            logger.debug(f"Response text: {response_text[:500]}")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error parsing response: {str(e)}")
-            return None
+        Args:
+            response: Parsed response, or None if OpenAI returned none.
+            cache_key: Response cache key for the image.
 
-    def _validate_and_parse_response(
-        self, parsed_data: dict
-    ) -> Optional[CropDetectionResponse]:
+        Returns:
+            Normalized CropDetectionResponse.
+
+        Raises:
+            ValueError: If OpenAI returned no analysis.
         """
-        Validate and parse response data into Pydantic model.
+        if response is None:
+            logger.error("Empty response from OpenAI")
+            raise ValueError("Failed to get response from OpenAI")
+
+        response = self._normalize_response(response)
+        self.response_cache.set(cache_key, response.model_dump_json())
+        return response
+
+    def _build_cache_key(self, image_digest: str) -> str:
+        """
+        Build the response cache key for an image.
 
         Args:
-            parsed_data: Parsed JSON dictionary.
+            image_digest: SHA256 hex digest of the image.
 
         Returns:
-            Validated CropDetectionResponse model or None.
+            Cache key covering the image, model, prompt and temperature.
         """
-        try:
-            # Handle case when image is not crop-related
-            if not parsed_data.get("is_crop_image", False):
-                logger.info("Image is not crop-related")
-                return CropDetectionResponse(
-                    is_crop_image=False,
-                    analysis_summary=parsed_data.get(
-                        "analysis_summary",
-                        "Image does not appear to contain crops."
-                    ),
-                    confidence_score=parsed_data.get("confidence_score")
+        return ResponseCache.build_key(
+            image_digest,
+            self.openai_client.model,
+            _PROMPT_VERSION,
+            self.openai_client.temperature
+        )
+
+    async def _retry_truncated(
+        self, attempt: Callable[[int], AsyncIterator[Any]]
+    ) -> AsyncIterator[Any]:
+        """
+        Run a streamed analysis attempt, retrying once with a larger token
+        budget if the response is truncated.
+
+        Args:
+            attempt: Called with a completion token budget; yields the
+                output of one streamed upstream call.
+
+        Yields:
+            Output of each attempt. A retried attempt starts over.
+
+        Raises:
+            LengthFinishReasonError: If the response is truncated even
+                with the retry budget.
+        """
+        for max_tokens in _TOKEN_BUDGETS:
+            try:
+                async for item in attempt(max_tokens):
+                    yield item
+                return
+            except LengthFinishReasonError:
+                if max_tokens == _RETRY_MAX_TOKENS:
+                    raise
+                logger.warning(
+                    "Truncated OpenAI response with max_tokens=%s, retrying",
+                    max_tokens
                 )
 
-            # Parse crop info
-            crop_info_data = parsed_data.get("crop_info", {})
-            crop_info = None
-            if crop_info_data:
-                crop_info = CropBasicInfo(**crop_info_data)
-
-            # Parse diseases
-            diseases_data = parsed_data.get("diseases", [])
-            diseases = None
-            if diseases_data:
-                diseases = [DiseaseInfo(**disease) for disease in diseases_data]
-
-            # Parse recommendations
-            recommendations_data = parsed_data.get("recommendations", {})
-            recommendations = None
-            if recommendations_data:
-                recommendations = TreatmentRecommendation(
-                    **recommendations_data
+    async def _analyze_single(
+        self, image_data_url: str
+    ) -> Optional[CropDetectionResponse]:
+        """
+        Analyze a single image with its own OpenAI request.
+
+        Args:
+            image_data_url: Base64 JPEG data URL.
+
+        Returns:
+            Validated analysis response, or None if the model refused.
+
+        Raises:
+            LengthFinishReasonError: If the response is truncated even
+                with the retry budget.
+        """
+        prompt = self._create_detection_prompt()
+
+        # Retry once with a larger budget if the response is truncated
+        for max_tokens in _TOKEN_BUDGETS:
+            try:
+                return await self.openai_client.analyze_image(
+                    image_data_url, prompt, max_tokens=max_tokens,
+                    read_timeout=_read_timeout(max_tokens)
+                )
+            except LengthFinishReasonError:
+                if max_tokens == _RETRY_MAX_TOKENS:
+                    raise
+                logger.warning(
+                    "Truncated OpenAI response with max_tokens=%s, retrying",
+                    max_tokens
                 )
 
-            response = CropDetectionResponse(
-                is_crop_image=True,
-                crop_info=crop_info,
-                diseases=diseases,
-                recommendations=recommendations,
-                analysis_summary=parsed_data.get(
-                    "analysis_summary",
-                    "Analysis completed successfully."
-                ),
-                confidence_score=parsed_data.get("confidence_score")
-            )
+    async def _analyze_batch(
+        self, image_data_urls: List[str]
+    ) -> List[CropDetectionResponse]:
+        """
+        Analyze several images with one OpenAI request.
 
-            logger.info("Successfully validated response data")
-            return response
+        Args:
+            image_data_urls: Base64 JPEG data URLs.
 
-        except ValidationError as e:
-            logger.error(f"Validation error: {str(e)}")
-            logger.debug(f"Validation errors: {e.errors()}")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error validating response: {str(e)}")
-            return None
+        Returns:
+            Validated analysis responses in image order.
+
+        Raises:
+            ValueError: If OpenAI returns no analysis.
+        """
+        image_count = len(image_data_urls)
+        prompt = self._create_batch_prompt(image_count)
+
+        # Scale the read timeout with the completion budget, capped by the
+        # batch timeout. A failed batch falls back to single calls, so SDK
+        # retries would only delay that fallback.
+        max_tokens = _MAX_TOKENS_PER_IMAGE * image_count
+        response = await self.openai_client.analyze_images(
+            image_data_urls, prompt, CropDetectionBatchResponse,
+            max_tokens=max_tokens,
+            read_timeout=min(
+                _read_timeout(max_tokens),
+                self._batcher.batch_timeout_seconds
+            ),
+            max_retries=0
+        )
+
+        if response is None:
+            logger.error("Empty batch response from OpenAI")
+            raise ValueError("Failed to get response from OpenAI")
+
+        return response.results
+
+    async def _run_detection(
+        self, image_data_url: str, cache_key: str
+    ) -> CropDetectionResponse:
+        """
+        Run an upstream detection and cache the result.
+
+        Args:
+            image_data_url: Base64 JPEG data URL.
+            cache_key: Response cache key for the image.
 
-    def detect_crop_disease(
-        self, image_base64: str
+        Returns:
+            CropDetectionResponse model with analysis results.
+        """
+        # Get analysis from OpenAI, batched with concurrent requests
+        return self._finish(
+            await self._batcher.submit(image_data_url), cache_key
+        )
+
+    async def detect_crop_disease(
+        self, image_data_url: str, image_digest: Optional[str] = None
     ) -> CropDetectionResponse:
         """
         Main method to detect crop disease from image.
 
         Args:
-            image_base64: Base64 encoded image string.
+            image_data_url: Base64 JPEG data URL.
+            image_digest: SHA256 hex digest of the image bytes. Computed
+                from the data URL when not provided.
 
         Returns:
             CropDetectionResponse model with analysis results.
@@ -202,41 +403,113 @@ class CropDetectionService:
         try:
             logger.info("Starting crop disease detection")
 
-            if not image_base64:
-                logger.error("Empty image data provided")
-                raise ValueError("Image data cannot be empty")
+            cache_key, cached_response = self._prepare(
+                image_data_url, image_digest
+            )
+            if cached_response is not None:
+                return cached_response
+
+            # Share one upstream call between concurrent identical requests
+            task = self._inflight.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(
+                    self._run_detection(image_data_url, cache_key)
+                )
+                self._inflight[cache_key] = task
+                task.add_done_callback(
+                    lambda _: self._inflight.pop(cache_key, None)
+                )
+            else:
+                logger.info("Joining in-flight analysis of identical image")
 
-            prompt = self._create_detection_prompt()
+            # Shield so a cancelled caller does not cancel shared work
+            validated_response = await asyncio.shield(task)
 
-            # Get analysis from OpenAI
-            response_text = self.openai_client.analyze_image(
-                image_base64, prompt
-            )
+            logger.info("Crop disease detection completed successfully")
+            return validated_response
 
-            if not response_text:
-                logger.error("Empty response from OpenAI")
-                raise ValueError("Failed to get response from OpenAI")
+        except Exception as e:
+            logger.error("Error in crop disease detection: %s", e)
+            raise
+
+    async def is_crop_image(self, image_data_url: str) -> bool:
+        """
+        Quickly check whether an image shows a crop.
+
+        Uses a short prompt and a low-detail image so non-crop uploads can
+        be turned away before the full analysis is requested.
+
+        Args:
+            image_data_url: Base64 JPEG data URL.
+
+        Returns:
+            False if the model judged the image not crop-related, True
+            otherwise, including when the model refused to answer.
+        """
+        response = await self.openai_client.analyze_images(
+            [image_data_url], _CROP_CHECK_PROMPT, CropImageCheck,
+            max_tokens=_CROP_CHECK_MAX_TOKENS, image_detail="low"
+        )
+        if response is None:
+            logger.warning("Crop check returned no answer, assuming crop")
+            return True
+
+        logger.info("Crop check result: %s", response.is_crop_image)
+        return response.is_crop_image
+
+    async def detect_crop_disease_stream(
+        self, image_data_url: str, image_digest: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Detect crop disease, yielding the analysis as it is generated.
+
+        Streamed requests bypass the micro-batcher and in-flight sharing,
+        since their partial output belongs to a single caller. Cache hits
+        yield the final result once, and completed analyses are cached
+        like those from detect_crop_disease.
+
+        Args:
+            image_data_url: Base64 JPEG data URL.
+            image_digest: SHA256 hex digest of the image bytes. Computed
+                from the data URL when not provided.
 
-            # Parse response
-            parsed_data = self._parse_openai_response(response_text)
+        Yields:
+            Partial analysis dicts, followed by the final analysis dict.
 
-            if not parsed_data:
-                logger.error("Failed to parse OpenAI response")
-                raise ValueError("Failed to parse analysis response")
+        Raises:
+            Exception: For analysis failures.
+        """
+        try:
+            logger.info("Starting streamed crop disease detection")
 
-            # Validate and create response model
-            validated_response = self._validate_and_parse_response(
-                parsed_data
+            cache_key, cached_response = self._prepare(
+                image_data_url, image_digest
             )
+            if cached_response is not None:
+                yield cached_response.model_dump()
+                return
 
-            if not validated_response:
-                logger.error("Failed to validate response data")
-                raise ValueError("Response validation failed")
+            prompt = self._create_detection_prompt()
 
-            logger.info("Crop disease detection completed successfully")
-            return validated_response
+            def attempt(max_tokens: int):
+                return self.openai_client.stream_image_analysis(
+                    image_data_url, prompt, max_tokens=max_tokens
+                )
+
+            # A truncated response is retried and streamed again from the
+            # start
+            response = None
+            async for parsed in self._retry_truncated(attempt):
+                if isinstance(parsed, CropDetectionResponse):
+                    response = parsed
+                else:
+                    yield parsed
+
+            response = self._finish(response, cache_key)
+
+            logger.info("Streamed crop disease detection completed")
+            yield response.model_dump()
 
         except Exception as e:
-            logger.error(f"Error in crop disease detection: {str(e)}")
+            logger.error("Error in crop disease detection: %s", e)
             raise
-
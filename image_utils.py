@@ -0,0 +1,46 @@
+"""Image helpers shared by the API and the Streamlit front end."""
+from PIL import Image
+
+# JPEG segments that carry metadata: APP1 holds EXIF (including GPS
+# location) and XMP, APP13 holds Photoshop/IPTC records
+_METADATA_MARKERS = ("APP1", "APP13")
+
+
+def can_send_unchanged(image: Image.Image, max_dimension: int) -> bool:
+    """
+    Check whether an uploaded image can be sent to OpenAI as uploaded.
+
+    Only small RGB or greyscale JPEGs without metadata qualify; anything
+    else must be re-encoded, which also strips EXIF and XMP. A qualifying
+    image is decoded once at 1/8 scale to confirm its data is intact, so
+    the image object should not be reused afterwards.
+
+    Args:
+        image: Opened, not yet loaded, PIL image.
+        max_dimension: Maximum width and height of images sent unchanged.
+
+    Returns:
+        True if the original bytes can be sent unchanged.
+
+    Raises:
+        OSError: If the JPEG data is truncated or corrupt.
+    """
+    if (
+        image.format != "JPEG"
+        or image.mode not in ("RGB", "L")
+        or max(image.size) > max_dimension
+    ):
+        return False
+
+    if "comment" in image.info or any(
+        marker in _METADATA_MARKERS
+        for marker, _ in getattr(image, "applist", ())
+    ):
+        return False
+
+    # libjpeg's DCT scaling keeps this decode cheap
+    image.draft(
+        image.mode, (max(1, image.width // 8), max(1, image.height // 8))
+    )
+    image.load()
+    return True
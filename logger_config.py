@@ -1,26 +1,32 @@
 """Logger configuration module for the crop detection application."""
+import atexit
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Optional
 
+# Shared queue handler; records are written by a background listener thread
+_queue_handler: Optional[QueueHandler] = None
 
-def setup_logger(name: str = __name__) -> logging.Logger:
+# Console handler owned by the listener; its level follows LOG_LEVEL
+_console_handler: Optional[logging.Handler] = None
+
+
+def _get_queue_handler() -> QueueHandler:
     """
-    Set up and configure a logger instance.
+    Create the shared queue handler and start its listener on first use.
 
-    Args:
-        name: Name of the logger, typically __name__ of the module.
+    The file and console handlers run on the listener's thread, so logging
+    calls on the request path only enqueue records.
 
     Returns:
-        Configured logger instance.
+        Queue handler feeding the shared listener.
     """
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-
-    # Prevent duplicate handlers
-    if logger.handlers:
-        return logger
+    global _queue_handler, _console_handler
+    if _queue_handler is not None:
+        return _queue_handler
 
     # Create logs directory if it doesn't exist
     log_dir = Path("logs")
@@ -48,15 +54,59 @@ def setup_logger(name: str = __name__) -> logging.Logger:
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(detailed_formatter)
 
-    # Console handler
+    # Console handler; the level is updated from .env by set_console_level
     console_handler = logging.StreamHandler()
-    console_level = os.getenv("LOG_LEVEL", "INFO").upper()
-    console_handler.setLevel(getattr(logging, console_level, logging.INFO))
+    console_handler.setLevel(_parse_level(os.getenv("LOG_LEVEL", "INFO")))
     console_handler.setFormatter(simple_formatter)
+    _console_handler = console_handler
+
+    # Hand records to a background thread that owns the real handlers
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(
+        log_queue, file_handler, console_handler,
+        respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
 
-    # Add handlers to logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    _queue_handler = QueueHandler(log_queue)
+    return _queue_handler
 
-    return logger
 
+def _parse_level(level_name: str) -> int:
+    """Map a level name such as "INFO" to its value, defaulting to INFO."""
+    return getattr(logging, level_name.upper(), logging.INFO)
+
+
+def set_console_level(level_name: str) -> None:
+    """
+    Set the console log level.
+
+    Args:
+        level_name: Logging level name such as "INFO"; unknown names fall
+            back to INFO.
+    """
+    _get_queue_handler()
+    _console_handler.setLevel(_parse_level(level_name))
+
+
+def setup_logger(name: str = __name__) -> logging.Logger:
+    """
+    Set up and configure a logger instance.
+
+    Args:
+        name: Name of the logger, typically __name__ of the module.
+
+    Returns:
+        Configured logger instance.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+
+    # Prevent duplicate handlers
+    if logger.handlers:
+        return logger
+
+    logger.addHandler(_get_queue_handler())
+
+    return logger
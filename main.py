@@ -1,29 +1,42 @@
 """Main FastAPI application for crop disease detection."""
-import base64
+import hashlib
 from io import BytesIO
 from typing import Optional
+import pybase64
 from fastapi import FastAPI, File, UploadFile, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from openai import BadRequestError
 from PIL import Image
 from logger_config import setup_logger
-from variables import (
-    ALLOWED_EXTENSIONS,
-    MAX_FILE_SIZE_MB,
-    API_HOST,
-    API_PORT
-)
+from image_utils import can_send_unchanged
+from variables import get_config
 from crop_detection import CropDetectionService
 from models import CropDetectionResponse
 
 # Initialize logger
 logger = setup_logger(__name__)
 
+# Application configuration
+config = get_config()
+
+# Prefer libjpeg-turbo's C API for JPEG encoding; fall back to Pillow when
+# PyTurboJPEG or the shared library is unavailable
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _TURBO_JPEG = TurboJPEG()
+    logger.info("Using TurboJPEG for JPEG encoding")
+except (ImportError, OSError, RuntimeError) as e:
+    _TURBO_JPEG = None
+    logger.info("TurboJPEG unavailable, using Pillow encoder: %s", e)
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Crop Disease Detection API",
     description="API for detecting crop diseases using OpenAI GPT-4o mini",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -35,10 +48,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upload size limit in bytes
+MAX_FILE_SIZE_BYTES = config.max_file_size_mb * 1024 * 1024
+
+# Prefix of the data URLs sent to the OpenAI API
+JPEG_DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+# Chunk size for streaming uploaded files into memory
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
 # Initialize service
 crop_service = CropDetectionService()
 
 
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    """Close the crop detection service on application shutdown."""
+    logger.info("Shutting down crop detection service")
+    await crop_service.close()
+
+
 def validate_image_file(file: UploadFile) -> None:
     """
     Validate uploaded image file.
@@ -52,40 +81,101 @@ def validate_image_file(file: UploadFile) -> None:
     try:
         # Check file extension
         file_extension = file.filename.split(".")[-1].lower() if "." in file.filename else ""
-        if file_extension not in ALLOWED_EXTENSIONS:
+        if file_extension not in config.allowed_extensions:
             logger.warning(
-                f"Invalid file extension: {file_extension}"
+                "Invalid file extension: %s", file_extension
             )
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=(
                     f"Invalid file type. Allowed extensions: "
-                    f"{', '.join(ALLOWED_EXTENSIONS)}"
+                    f"{', '.join(sorted(config.allowed_extensions))}"
+                )
+            )
+
+        # Reject oversized uploads from the declared size before reading
+        if file.size is not None and file.size > MAX_FILE_SIZE_BYTES:
+            logger.warning("Upload size %s bytes exceeds limit", file.size)
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=(
+                    f"File exceeds maximum allowed size "
+                    f"({config.max_file_size_mb}MB)"
                 )
             )
 
-        # Check file size (will be validated after reading)
-        logger.info(f"Validating image file: {file.filename}")
+        logger.info("Validating image file: %s", file.filename)
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error validating file: {str(e)}")
+        logger.error("Error validating file: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"File validation error: {str(e)}"
         )
 
 
-def encode_image_to_base64(image_bytes: bytes) -> str:
+async def read_upload(file: UploadFile) -> bytes:
     """
-    Encode image bytes to base64 string.
+    Read an uploaded file in chunks, enforcing the size limit.
+
+    Args:
+        file: Uploaded file object.
+
+    Returns:
+        File content bytes.
+
+    Raises:
+        HTTPException: If the file exceeds the size limit.
+    """
+    buffer = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buffer.extend(chunk)
+        if len(buffer) > MAX_FILE_SIZE_BYTES:
+            logger.warning("Upload exceeds size limit while reading")
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=(
+                    f"File exceeds maximum allowed size "
+                    f"({config.max_file_size_mb}MB)"
+                )
+            )
+    return bytes(buffer)
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    """
+    Encode an RGB image as JPEG at quality 85.
+
+    Args:
+        image: RGB image to encode.
+
+    Returns:
+        JPEG bytes.
+    """
+    if _TURBO_JPEG is not None:
+        return _TURBO_JPEG.encode(
+            np.asarray(image),
+            quality=85,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_420
+        )
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85, optimize=True)
+    return buffer.getvalue()
+
+
+def encode_image_to_data_url(image_bytes: bytes) -> str:
+    """
+    Encode image bytes to a base64 JPEG data URL.
 
     Args:
         image_bytes: Image file bytes.
 
     Returns:
-        Base64 encoded string.
+        Data URL ready to send to the OpenAI API.
 
     Raises:
         HTTPException: If encoding fails.
@@ -93,37 +183,53 @@ def encode_image_to_base64(image_bytes: bytes) -> str:
     try:
         # Validate and process image
         image = Image.open(BytesIO(image_bytes))
-        
-        # Convert to RGB if necessary
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        
-        # Save to bytes buffer
-        buffer = BytesIO()
-        image.save(buffer, format="JPEG", quality=85)
-        image_bytes = buffer.getvalue()
+
+        if can_send_unchanged(image, config.max_image_dimension):
+            # Small, metadata-free JPEGs are already in the target format
+            logger.debug("Image is a small JPEG, skipping re-encode")
+        else:
+            # Let libjpeg decode large JPEGs at a reduced scale; no-op for
+            # other formats
+            image.draft(
+                "RGB",
+                (config.max_image_dimension, config.max_image_dimension)
+            )
+
+            # Convert to RGB if necessary
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+
+            # Downscale large images; no-op for images already within bounds
+            image.thumbnail(
+                (config.max_image_dimension, config.max_image_dimension),
+                Image.Resampling.LANCZOS
+            )
+
+            image_bytes = encode_jpeg(image)
 
         # Check file size
         size_mb = len(image_bytes) / (1024 * 1024)
-        if size_mb > MAX_FILE_SIZE_MB:
-            logger.warning(f"Image size {size_mb:.2f}MB exceeds limit")
+        if size_mb > config.max_file_size_mb:
+            logger.warning("Image size %.2fMB exceeds limit", size_mb)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=(
                     f"Image size ({size_mb:.2f}MB) exceeds maximum "
-                    f"allowed size ({MAX_FILE_SIZE_MB}MB)"
+                    f"allowed size ({config.max_file_size_mb}MB)"
                 )
             )
 
-        # Encode to base64
-        encoded = base64.b64encode(image_bytes).decode("utf-8")
-        logger.info(f"Image encoded successfully, size: {size_mb:.2f}MB")
-        return encoded
+        # Encode to a base64 data URL in a single concatenation
+        data_url = JPEG_DATA_URL_PREFIX + pybase64.b64encode_as_string(
+            image_bytes
+        )
+        logger.info("Image encoded successfully, size: %.2fMB", size_mb)
+        return data_url
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error encoding image: {str(e)}")
+        logger.error("Error encoding image: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Image processing error: {str(e)}"
@@ -149,13 +255,13 @@ async def detect_crop_disease(file: UploadFile = File(...)):
         HTTPException: For validation or processing errors.
     """
     try:
-        logger.info(f"Received image upload request: {file.filename}")
+        logger.info("Received image upload request: %s", file.filename)
 
         # Validate file
         validate_image_file(file)
 
         # Read file content
-        file_content = await file.read()
+        file_content = await read_upload(file)
         if not file_content:
             logger.error("Empty file received")
             raise HTTPException(
@@ -163,25 +269,34 @@ async def detect_crop_disease(file: UploadFile = File(...)):
                 detail="File is empty"
             )
 
-        # Encode image to base64
-        image_base64 = encode_image_to_base64(file_content)
+        # Encode image to a base64 data URL
+        image_data_url = encode_image_to_data_url(file_content)
+        image_digest = hashlib.sha256(file_content).hexdigest()
 
         # Perform crop disease detection
-        result = crop_service.detect_crop_disease(image_base64)
+        result = await crop_service.detect_crop_disease(
+            image_data_url, image_digest
+        )
 
         logger.info("Crop disease detection completed successfully")
         return result
 
     except HTTPException:
         raise
+    except BadRequestError as e:
+        logger.error("OpenAI rejected the image: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Image could not be analyzed: {e.message}"
+        )
     except ValueError as e:
-        logger.error(f"Value error: {str(e)}")
+        logger.error("Value error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal server error: {str(e)}"
@@ -200,8 +315,8 @@ async def global_exception_handler(request, exc):
     Returns:
         JSON error response.
     """
-    logger.error(f"Unhandled exception: {str(exc)}", exc_info=True)
-    return JSONResponse(
+    logger.error("Unhandled exception: %s", exc, exc_info=True)
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "detail": "An unexpected error occurred",
@@ -215,8 +330,8 @@ if __name__ == "__main__":
     logger.info("Starting Crop Disease Detection API server")
     uvicorn.run(
         "main:app",
-        host=API_HOST,
-        port=API_PORT,
+        host=config.api_host,
+        port=config.api_port,
         reload=True,
         log_level="info"
     )
@@ -0,0 +1,142 @@
+"""Asyncio micro-batcher that coalesces concurrent calls into batches."""
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class MicroBatcher:
+    """Coalesce items submitted within a short window into one batch call."""
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+        single_fn: Callable[[Any], Awaitable[Any]],
+        max_batch_size: int,
+        window_seconds: float,
+        batch_timeout_seconds: float
+    ):
+        """
+        Initialize micro-batcher.
+
+        Args:
+            batch_fn: Coroutine processing a list of items, returning one
+                result per item in the same order.
+            single_fn: Coroutine processing a single item, used for
+                batches of one and as fallback when a batch fails.
+            max_batch_size: Maximum number of items per batch. Values of
+                1 or less disable batching.
+            window_seconds: How long to wait for more items after the
+                first item of a batch arrives.
+            batch_timeout_seconds: Time limit for a single batch call.
+        """
+        self._batch_fn = batch_fn
+        self._single_fn = single_fn
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self.batch_timeout_seconds = batch_timeout_seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatches: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Submit an item and wait for its result.
+
+        Args:
+            item: Item to process.
+
+        Returns:
+            Result produced for the item.
+        """
+        if self.max_batch_size <= 1:
+            return await self._single_fn(item)
+
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._collect())
+
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def close(self) -> None:
+        """Stop the collector and any in-flight batch dispatches."""
+        tasks = list(self._dispatches)
+        if self._worker is not None:
+            tasks.append(self._worker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+
+    async def _collect(self) -> None:
+        """Group queued items into batches and dispatch them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window_seconds
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), remaining)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            task = loop.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        """
+        Process one batch and resolve its waiters.
+
+        Args:
+            batch: Pairs of submitted item and the future awaiting it.
+        """
+        pending = [
+            (item, future) for item, future in batch if not future.done()
+        ]
+        if not pending:
+            return
+
+        items = [item for item, _ in pending]
+        if len(items) == 1:
+            results = await asyncio.gather(
+                self._single_fn(items[0]), return_exceptions=True
+            )
+        else:
+            try:
+                logger.info("Dispatching batch of %s items", len(items))
+                results = await asyncio.wait_for(
+                    self._batch_fn(items), self.batch_timeout_seconds
+                )
+                if len(results) != len(items):
+                    raise ValueError(
+                        f"Batch returned {len(results)} results "
+                        f"for {len(items)} items"
+                    )
+            except Exception as e:
+                logger.warning(
+                    "Batch call failed, falling back to single calls: %s", e
+                )
+                results = await asyncio.gather(
+                    *(self._single_fn(item) for item in items),
+                    return_exceptions=True
+                )
+
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -69,3 +69,19 @@ class CropDetectionResponse(BaseModel):
     analysis_summary: str = Field(
         ..., description="Summary of the analysis performed"
     )
+
+
+class CropDetectionBatchResponse(BaseModel):
+    """Response model for analyzing several images in one request."""
+
+    results: List[CropDetectionResponse] = Field(
+        ..., description="Analysis of each image, in image order"
+    )
+
+
+class CropImageCheck(BaseModel):
+    """Response model for the quick crop image check."""
+
+    is_crop_image: bool = Field(
+        ..., description="Whether the uploaded image contains a crop"
+    )
@@ -1,153 +1,248 @@
 """OpenAI client wrapper for image analysis."""
-from typing import Optional
-from openai import OpenAI
-from openai import APIError, APIConnectionError, RateLimitError
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Type, TypeVar, \
+    Union
+import httpx
+from openai import AsyncOpenAI
+from openai import APIError, APIConnectionError, LengthFinishReasonError, \
+    RateLimitError
+from pydantic import BaseModel
 from logger_config import setup_logger
-from variables import OPENAI_API_KEY, OPENAI_MODEL
+from models import CropDetectionResponse
+from variables import get_config
 
 logger = setup_logger(__name__)
 
+# Connection pool shared by all requests made through the client
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100)
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+ResponseModel = TypeVar("ResponseModel", bound=BaseModel)
+
+
+@contextmanager
+def _log_api_errors():
+    """Log errors raised by an OpenAI call and re-raise them."""
+    try:
+        yield
+    except LengthFinishReasonError as e:
+        logger.warning("OpenAI response truncated: %s", e)
+        raise
+    except RateLimitError as e:
+        logger.error("OpenAI rate limit exceeded: %s", e)
+        raise
+    except APIConnectionError as e:
+        logger.error("OpenAI connection error: %s", e)
+        raise
+    except APIError as e:
+        logger.error("OpenAI API error: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error during image analysis: %s", e)
+        raise
+
 
 class OpenAIClient:
     """Wrapper class for OpenAI API interactions."""
 
     def __init__(self):
-        """Initialize OpenAI client with API key."""
+        """Initialize async OpenAI client with API key."""
         try:
-            self.client = OpenAI(api_key=OPENAI_API_KEY)
-            self.model = OPENAI_MODEL
-            logger.info(f"OpenAI client initialized with model: {self.model}")
+            config = get_config()
+            self._http = httpx.AsyncClient(
+                limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT
+            )
+            self.client = AsyncOpenAI(
+                api_key=config.openai_api_key, http_client=self._http
+            )
+            self.model = config.openai_model
+            self.temperature = 0.3
+            logger.info("OpenAI client initialized with model: %s", self.model)
         except Exception as e:
-            logger.error(f"Failed to initialize OpenAI client: {str(e)}")
+            logger.error("Failed to initialize OpenAI client: %s", e)
             raise
 
-    def analyze_image(
-        self, image_base64: str, prompt: str
-    ) -> Optional[str]:
+    async def close(self) -> None:
+        """Close the underlying HTTP connection pool."""
+        await self._http.aclose()
+        logger.info("OpenAI client connection pool closed")
+
+    @staticmethod
+    def _build_messages(
+        image_data_urls: List[str], prompt: str, image_detail: str = "auto"
+    ) -> List[Dict[str, Any]]:
+        """
+        Build the chat messages for an image analysis request.
+
+        Args:
+            image_data_urls: Base64 JPEG data URLs.
+            prompt: Prompt for image analysis.
+            image_detail: Vision detail level for the images.
+
+        Returns:
+            Single user message carrying the prompt and images.
+        """
+        content = [{"type": "text", "text": prompt}]
+        for index, image_data_url in enumerate(image_data_urls, 1):
+            if len(image_data_urls) > 1:
+                content.append({"type": "text", "text": f"Image {index}:"})
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": image_data_url, "detail": image_detail}
+            })
+        return [{"role": "user", "content": content}]
+
+    async def analyze_image(
+        self, image_data_url: str, prompt: str,
+        max_tokens: int = 1200, read_timeout: Optional[float] = None
+    ) -> Optional[CropDetectionResponse]:
         """
-        Analyze image using OpenAI Vision API.
+        Analyze image using OpenAI Vision API with structured output.
 
         Args:
-            image_base64: Base64 encoded image string.
+            image_data_url: Base64 JPEG data URL.
             prompt: Prompt for image analysis.
+            max_tokens: Completion token limit for the response.
+            read_timeout: Read timeout for this call in seconds, replacing
+                the pool's default.
 
         Returns:
-            Response text from OpenAI API.
+            Validated CropDetectionResponse, or None if the model refused.
 
         Raises:
             APIError: For OpenAI API errors.
             APIConnectionError: For connection errors.
             RateLimitError: For rate limit errors.
-            ValueError: For invalid input.
+            LengthFinishReasonError: If the response hit max_tokens.
         """
-        try:
-            logger.info("Starting image analysis with OpenAI")
-            logger.debug(f"Prompt: {prompt[:100]}...")
+        return await self.analyze_images(
+            [image_data_url], prompt, CropDetectionResponse, max_tokens,
+            read_timeout=read_timeout
+        )
+
+    async def analyze_images(
+        self, image_data_urls: List[str], prompt: str,
+        response_format: Type[ResponseModel], max_tokens: int,
+        image_detail: str = "auto", read_timeout: Optional[float] = None,
+        max_retries: Optional[int] = None
+    ) -> Optional[ResponseModel]:
+        """
+        Analyze one or more images in a single structured output call.
+
+        The response is constrained to the JSON schema of response_format
+        and returned already validated. When several images are sent,
+        each is preceded by an "Image N:" label so the prompt can refer to
+        them by position.
+
+        Args:
+            image_data_urls: Base64 JPEG data URLs.
+            prompt: Prompt for image analysis.
+            response_format: Pydantic model describing the response.
+            max_tokens: Completion token limit for the whole response.
+            image_detail: Vision detail level; "low" sends each image as a
+                fixed, small number of tokens.
+            read_timeout: Read timeout for this call in seconds, replacing
+                the pool's default.
+            max_retries: SDK retry count for this call, replacing the
+                client's default.
 
-            response = self.client.chat.completions.create(
+        Returns:
+            Parsed response model, or None if the model refused.
+
+        Raises:
+            APIError: For OpenAI API errors.
+            APIConnectionError: For connection errors.
+            RateLimitError: For rate limit errors.
+            LengthFinishReasonError: If the response hit max_tokens.
+        """
+        with _log_api_errors():
+            logger.info(
+                "Starting analysis of %s image(s) with OpenAI",
+                len(image_data_urls)
+            )
+            logger.debug("Prompt: %s...", prompt[:100])
+
+            client = self.client
+            if read_timeout is not None or max_retries is not None:
+                client = self.client.with_options(
+                    timeout=httpx.Timeout(
+                        read_timeout or HTTP_TIMEOUT.read,
+                        connect=HTTP_TIMEOUT.connect
+                    ),
+                    max_retries=(
+                        self.client.max_retries
+                        if max_retries is None else max_retries
+                    )
+                )
+
+            response = await client.beta.chat.completions.parse(
                 model=self.model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": prompt
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=500,
-                temperature=0.3
+                messages=self._build_messages(
+                    image_data_urls, prompt, image_detail
+                ),
+                response_format=response_format,
+                max_tokens=max_tokens,
+                temperature=self.temperature
             )
 
-            response_text = response.choices[0].message.content
-            logger.info("Image analysis completed successfully")
-            logger.debug(f"Response length: {len(response_text)} characters")
+            choice = response.choices[0]
+            logger.info(
+                "Image analysis completed (finish_reason=%s, "
+                "completion_tokens=%s, max_tokens=%s)",
+                choice.finish_reason,
+                response.usage.completion_tokens if response.usage else None,
+                max_tokens
+            )
 
-            return response_text
+            if choice.message.refusal:
+                logger.warning(
+                    "OpenAI refused the analysis: %s", choice.message.refusal
+                )
 
-        except RateLimitError as e:
-            logger.error(f"OpenAI rate limit exceeded: {str(e)}")
-            raise
-        except APIConnectionError as e:
-            logger.error(f"OpenAI connection error: {str(e)}")
-            raise
-        except APIError as e:
-            logger.error(f"OpenAI API error: {str(e)}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error during image analysis: {str(e)}")
-            raise
+            return choice.message.parsed
 
-    def analyze_with_structured_output(
-        self, image_base64: str, system_prompt: str,
-        response_format: dict
-    ) -> Optional[str]:
+    async def stream_image_analysis(
+        self, image_data_url: str, prompt: str,
+        max_tokens: int = 1200
+    ) -> AsyncIterator[Union[Dict[str, Any], CropDetectionResponse]]:
         """
-        Analyze image with structured output format.
+        Analyze an image with structured output, streaming the response.
 
         Args:
-            image_base64: Base64 encoded image string.
-            system_prompt: System prompt for analysis.
-            response_format: Structured output format specification.
+            image_data_url: Base64 JPEG data URL.
+            prompt: Prompt for image analysis.
+            max_tokens: Completion token limit for the response.
 
-        Returns:
-            JSON response string.
+        Yields:
+            Partially parsed response dicts as content arrives, followed
+            by the validated CropDetectionResponse. Nothing further is
+            yielded if the model refused.
 
         Raises:
             APIError: For OpenAI API errors.
-            Exception: For other errors.
+            APIConnectionError: For connection errors.
+            RateLimitError: For rate limit errors.
+            LengthFinishReasonError: If the response hit max_tokens.
         """
-        try:
-            logger.info("Starting structured output image analysis")
+        with _log_api_errors():
+            logger.info("Starting streamed image analysis with OpenAI")
 
-            response = self.client.beta.chat.completions.parse(
+            async with self.client.beta.chat.completions.stream(
                 model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": (
-                                    "Please analyze this image and provide "
-                                    "a detailed crop disease analysis."
-                                )
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": (
-                                        f"data:image/jpeg;base64,{image_base64}"
-                                    )
-                                }
-                            }
-                        ]
-                    }
-                ],
-                response_format=response_format,
-                max_tokens=2000,
-                temperature=0.3
-            )
-
-            result = response.choices[0].message.content
-            logger.info("Structured output analysis completed")
-            return result
-
-        except Exception as e:
-            logger.error(
-                f"Error in structured output analysis: {str(e)}"
-            )
-            raise
-
+                messages=self._build_messages([image_data_url], prompt),
+                response_format=CropDetectionResponse,
+                max_tokens=max_tokens,
+                temperature=self.temperature
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content.delta":
+                        if event.parsed:
+                            yield event.parsed
+                    elif event.type == "content.done":
+                        yield event.parsed
+                    elif event.type == "refusal.done":
+                        logger.warning(
+                            "OpenAI refused the analysis: %s", event.refusal
+                        )
+
+            logger.info("Streamed image analysis completed")
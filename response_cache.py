@@ -0,0 +1,98 @@
+"""Content-addressed cache for crop detection responses."""
+import hashlib
+from typing import Optional
+from cachetools import TTLCache
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+# Cache policies: "enabled" reads and writes, "read_only" serves hits but
+# never stores new entries, "replay" serves hits and refuses to call the
+# upstream API on a miss, "disabled" bypasses the cache entirely.
+CACHE_MODE_ENABLED = "enabled"
+CACHE_MODE_READ_ONLY = "read_only"
+CACHE_MODE_REPLAY = "replay"
+CACHE_MODE_DISABLED = "disabled"
+CACHE_MODES = (
+    CACHE_MODE_ENABLED,
+    CACHE_MODE_READ_ONLY,
+    CACHE_MODE_REPLAY,
+    CACHE_MODE_DISABLED,
+)
+
+
+class ResponseCache:
+    """TTL-bounded LRU cache of serialized detection responses."""
+
+    def __init__(self, mode: str, max_entries: int, ttl_seconds: int):
+        """
+        Initialize response cache.
+
+        Args:
+            mode: Cache policy, one of CACHE_MODES.
+            max_entries: Maximum number of cached responses.
+            ttl_seconds: Time-to-live for each cached response.
+
+        Raises:
+            ValueError: If the cache mode is not recognized.
+        """
+        if mode not in CACHE_MODES:
+            error_msg = (
+                f"Invalid CACHE_MODE '{mode}'. "
+                f"Allowed values: {', '.join(CACHE_MODES)}"
+            )
+            logger.error(error_msg)
+            raise ValueError(error_msg)
+
+        self.mode = mode
+        self._store = TTLCache(maxsize=max_entries, ttl=ttl_seconds)
+        logger.info(
+            "Response cache initialized (mode=%s, max_entries=%s, ttl=%ss)",
+            mode, max_entries, ttl_seconds
+        )
+
+    @staticmethod
+    def build_key(
+        image_digest: str, model: str, prompt_version: str,
+        temperature: float
+    ) -> str:
+        """
+        Build a cache key from everything that determines the response.
+
+        Args:
+            image_digest: SHA256 hex digest of the image bytes.
+            model: OpenAI model name.
+            prompt_version: Version tag of the detection prompt.
+            temperature: Sampling temperature used for the request.
+
+        Returns:
+            SHA256 hex digest identifying the request.
+        """
+        raw_key = f"{image_digest}|{model}|{prompt_version}|{temperature}"
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Args:
+            key: Cache key from build_key.
+
+        Returns:
+            Serialized response JSON or None on miss.
+        """
+        if self.mode == CACHE_MODE_DISABLED:
+            return None
+        return self._store.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        """
+        Store a serialized response if the cache mode allows writes.
+
+        Args:
+            key: Cache key from build_key.
+            value: Serialized response JSON.
+        """
+        if self.mode != CACHE_MODE_ENABLED:
+            return
+        self._store[key] = value
@@ -1,26 +1,19 @@
 """Streamlit UI for Crop Disease Detection."""
 import streamlit as st
-import base64
+import asyncio
+import hashlib
+import html
+import queue
+import threading
+import pybase64
 from PIL import Image
 import io
-from typing import Optional
-import os
-from dotenv import load_dotenv
-from crop_detection import CropDetectionService
-
-# Load environment variables
-load_dotenv()
-
-# Page configuration
-st.set_page_config(
-    page_title="Crop Disease Detection",
-    page_icon="🌾",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+from typing import AsyncIterator, Iterator, Optional
+from image_utils import can_send_unchanged
+from variables import get_config
 
 # Custom CSS for attractive styling
-st.markdown("""
+_CSS = """
     <style>
     .main-header {
         font-size: 3rem;
@@ -68,26 +61,192 @@ st.markdown("""
         background-color: #228B22;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# Severity level to indicator emoji for disease cards
+_SEVERITY_EMOJI = {
+    'mild': '🟡',
+    'moderate': '🟠',
+    'severe': '🔴'
+}
+
+# Page configuration
+st.set_page_config(
+    page_title="Crop Disease Detection",
+    page_icon="🌾",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+
+
+@st.cache_data(show_spinner=False)
+def get_compiled_css() -> str:
+    """
+    Return the custom CSS with insignificant whitespace collapsed.
+
+    Streamlit removes elements that a rerun does not emit again, so the
+    style block must be sent on every run; caching keeps it small and
+    built once per process.
+    """
+    return " ".join(_CSS.split())
+
+
+# Inject custom CSS
+st.markdown(get_compiled_css(), unsafe_allow_html=True)
 
 # Initialize crop detection service
 @st.cache_resource
 def get_crop_service():
     """Initialize and cache the crop detection service."""
+    # Imported here so the OpenAI SDK and models load on first use rather
+    # than delaying the first render
+    from crop_detection import CropDetectionService
     return CropDetectionService()
 
 
-def encode_image_to_base64(image_bytes: bytes) -> str:
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Start and cache a background event loop for async service calls."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    """
+    Run a coroutine on the background event loop and wait for its result.
+
+    The loop is shared across reruns so the OpenAI client's connections
+    stay bound to a single, long-lived event loop.
+
+    Args:
+        coro: Coroutine to execute.
+
+    Returns:
+        Result of the coroutine.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+def iter_async(async_iterator: AsyncIterator) -> Iterator:
+    """
+    Consume an async iterator on the background event loop.
+
+    Items are handed to the script thread through a queue as they are
+    produced, so the caller can render each one without waiting for the
+    iterator to finish. If the script run is stopped while rendering an
+    item, closing this generator cancels the iterator.
+
+    Args:
+        async_iterator: Async iterator to consume.
+
+    Yields:
+        Items produced by the async iterator.
     """
-    Encode image bytes to base64 string.
+    items: queue.Queue = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        # Re-raise any error from the iterator
+        future.result()
+    finally:
+        if not future.done():
+            future.cancel()
+
+
+def encode_image_to_data_url(image_bytes: bytes) -> str:
+    """
+    Encode JPEG image bytes to a base64 data URL.
+    
+    Args:
+        image_bytes: JPEG image bytes.
+        
+    Returns:
+        Data URL ready to pass to the crop detection service.
+    """
+    return "data:image/jpeg;base64," + pybase64.b64encode_as_string(image_bytes)
+
+
+def prepare_image(uploaded_file, max_dimension: int) -> None:
+    """
+    Canonicalize an upload to JPEG and keep it in session state.
+    
+    Small, metadata-free JPEGs are kept as uploaded; other images are
+    converted, downscaled and re-encoded, which strips EXIF and XMP.
+    Reruns with the same upload reuse the stored JPEG bytes and data URL
+    instead of decoding the image again.
     
     Args:
-        image_bytes: Image file bytes.
+        uploaded_file: Streamlit uploaded file.
+        max_dimension: Maximum width and height of the JPEG image.
+    
+    Raises:
+        OSError: If the image cannot be decoded.
+    """
+    image_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.sha256(image_bytes).hexdigest()
+    if st.session_state.get('_img_hash') == file_hash:
+        return
+    
+    pil_image = Image.open(io.BytesIO(image_bytes))
+    if not can_send_unchanged(pil_image, max_dimension):
+        if pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        
+        # Downscale in place, preserving aspect ratio
+        pil_image.thumbnail(
+            (max_dimension, max_dimension), Image.Resampling.LANCZOS
+        )
         
+        # Save to bytes buffer as JPEG
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format="JPEG", quality=85)
+        image_bytes = buffer.getvalue()
+    
+    st.session_state['_img_hash'] = file_hash
+    st.session_state['_img_bytes_jpeg'] = image_bytes
+    st.session_state['_img_sha'] = hashlib.sha256(image_bytes).hexdigest()
+    st.session_state['_img_b64'] = encode_image_to_data_url(image_bytes)
+
+
+# Shown when the quick check turns an image away before the full analysis
+_QUICK_CHECK_SUMMARY = (
+    "A quick low-detail check found no crop in this image, so the full "
+    "analysis was skipped. If the image does show a crop, run the full "
+    "analysis anyway."
+)
+
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _cached_is_crop(img_sha: str, _image_data_url: str) -> bool:
+    """
+    Run the quick crop image check, cached by image hash.
+
+    The data URL is excluded from Streamlit's argument hashing (leading
+    underscore); the SHA-256 of the JPEG bytes identifies the image.
+
+    Args:
+        img_sha: SHA-256 hex digest of the JPEG bytes.
+        _image_data_url: Base64 data URL of the JPEG image.
+
     Returns:
-        Base64 encoded string.
+        Whether the image appears to contain a crop.
     """
-    return base64.b64encode(image_bytes).decode("utf-8")
+    crop_service = get_crop_service()
+    return run_async(crop_service.is_crop_image(_image_data_url))
 
 
 def display_crop_info(crop_info: dict) -> None:
@@ -110,29 +269,38 @@ def display_diseases(diseases: list) -> None:
     if diseases:
         st.markdown("### 🦠 Detected Diseases")
         
+        # Build every card first and render them in a single call
+        parts = []
         for idx, disease in enumerate(diseases, 1):
-            with st.container():
-                disease_name = disease.get('disease_name', 'Unknown')
-                severity = disease.get('severity', 'N/A')
-                confidence = disease.get('confidence')
-                affected_areas = disease.get('affected_areas', [])
-                affected_areas_str = ', '.join(affected_areas) if affected_areas else 'N/A'
-                
-                severity_emoji = {
-                    'mild': '🟡',
-                    'moderate': '🟠',
-                    'severe': '🔴'
-                }.get(severity.lower(), '⚪')
-                
-                confidence_str = f" ({confidence:.0%})" if confidence else ""
-                
-                st.markdown(f"""
-                <div class="disease-box">
-                    <h4>{severity_emoji} Disease #{idx}: {disease_name}</h4>
-                    <p><strong>Severity:</strong> {severity.title()}{confidence_str}</p>
-                    <p><strong>Affected Areas:</strong> {affected_areas_str}</p>
-                </div>
-                """, unsafe_allow_html=True)
+            disease_name = html.escape(disease.get('disease_name') or 'Unknown')
+            severity = disease.get('severity') or 'N/A'
+            confidence = disease.get('confidence')
+            affected_areas = disease.get('affected_areas') or []
+            affected_areas_str = html.escape(', '.join(affected_areas)) if affected_areas else 'N/A'
+            
+            severity_emoji = _SEVERITY_EMOJI.get(severity.lower(), '⚪')
+            
+            confidence_str = f" ({confidence:.0%})" if confidence else ""
+            
+            parts.append(
+                f'<div class="disease-box">'
+                f'<h4>{severity_emoji} Disease #{idx}: {disease_name}</h4>'
+                f'<p><strong>Severity:</strong> {html.escape(severity.title())}{confidence_str}</p>'
+                f'<p><strong>Affected Areas:</strong> {affected_areas_str}</p>'
+                f'</div>'
+            )
+        
+        st.markdown("\n".join(parts), unsafe_allow_html=True)
+
+
+# Recommendation fields and their headings, in display order
+_RECOMMENDATION_SECTIONS = (
+    ('immediate_actions', '🚨 Immediate Actions'),
+    ('preventive_measures', '🛡️ Preventive Measures'),
+    ('treatment_methods', '🔧 Treatment Methods'),
+    ('chemical_treatments', '🧪 Chemical Treatments'),
+    ('organic_treatments', '🌿 Organic Treatments'),
+)
 
 
 def display_recommendations(recommendations: dict) -> None:
@@ -140,39 +308,85 @@ def display_recommendations(recommendations: dict) -> None:
     if recommendations:
         st.markdown("### 💊 Treatment Recommendations")
         
-        # Immediate Actions
-        if recommendations.get('immediate_actions'):
-            st.markdown("**🚨 Immediate Actions:**")
-            for action in recommendations['immediate_actions']:
-                st.markdown(f"- {action}")
+        # Build every section first and render them in a single call
+        parts = []
+        for key, heading in _RECOMMENDATION_SECTIONS:
+            items = recommendations.get(key)
+            if items:
+                parts.append(f"<p><strong>{heading}:</strong></p>")
+                parts.append(
+                    "<ul>"
+                    + "".join(f"<li>{html.escape(item)}</li>" for item in items)
+                    + "</ul>"
+                )
+        
+        if parts:
+            st.markdown("\n".join(parts), unsafe_allow_html=True)
+
+
+def _clear_results() -> None:
+    """Drop the stored analysis result; runs before the next script run."""
+    st.session_state.pop('analysis_result', None)
+
+
+def _force_full_analysis() -> None:
+    """Skip the quick crop check for the current image on the next run."""
+    st.session_state['_skip_crop_check'] = st.session_state.get('_img_sha')
+
+
+def _render_results(result: dict, partial: bool = False) -> None:
+    """
+    Display an analysis result.
+    
+    Args:
+        result: Analysis result dictionary
+        partial: Whether the result is still streaming. Partial results
+            skip conclusions drawn from missing fields and the clear
+            button, which must only be created once per script run.
+    """
+    # Display analysis summary
+    if result.get('analysis_summary'):
+        st.markdown("### 📝 Analysis Summary")
+        st.info(result['analysis_summary'])
+    
+    # Wait for the crop verdict before drawing conclusions from it
+    if partial and 'is_crop_image' not in result:
+        return
+    
+    # Check if image is crop-related
+    if not result.get('is_crop_image', False):
+        st.warning("⚠️ This image does not appear to contain crop-related content.")
         
-        # Preventive Measures
-        if recommendations.get('preventive_measures'):
-            st.markdown("**🛡️ Preventive Measures:**")
-            for measure in recommendations['preventive_measures']:
-                st.markdown(f"- {measure}")
+        # The quick check can miss crops; let the user override it
+        if result.get('quick_check') and not partial:
+            st.button("🔬 Run Full Analysis Anyway", on_click=_force_full_analysis)
+    else:
+        st.success("✅ Crop detected in image!")
         
-        # Treatment Methods
-        if recommendations.get('treatment_methods'):
-            st.markdown("**🔧 Treatment Methods:**")
-            for method in recommendations['treatment_methods']:
-                st.markdown(f"- {method}")
+        # Display crop information
+        if result.get('crop_info'):
+            display_crop_info(result['crop_info'])
         
-        # Chemical Treatments
-        if recommendations.get('chemical_treatments'):
-            st.markdown("**🧪 Chemical Treatments:**")
-            for treatment in recommendations['chemical_treatments']:
-                st.markdown(f"- {treatment}")
+        # Display diseases
+        if result.get('diseases'):
+            display_diseases(result['diseases'])
+        elif not partial:
+            st.success("🎉 No diseases detected! Your crop appears healthy.")
         
-        # Organic Treatments
-        if recommendations.get('organic_treatments'):
-            st.markdown("**🌿 Organic Treatments:**")
-            for treatment in recommendations['organic_treatments']:
-                st.markdown(f"- {treatment}")
+        # Display recommendations
+        if result.get('recommendations'):
+            display_recommendations(result['recommendations'])
+    
+    # Option to clear results
+    if not partial:
+        st.markdown("---")
+        st.button("🔄 Clear Results", on_click=_clear_results)
 
 
 def main():
     """Main Streamlit application."""
+    config = get_config()
+    
     # Header
     st.markdown('<h1 class="main-header">🌾 Crop Disease Detection</h1>', unsafe_allow_html=True)
     st.markdown('<p class="sub-header">Upload an image to detect crop diseases and get treatment recommendations</p>', unsafe_allow_html=True)
@@ -203,6 +417,10 @@ def main():
     # Main content area
     col1, col2 = st.columns([1, 1])
     
+    with col2:
+        st.markdown("### 📊 Analysis Results")
+        results_placeholder = st.empty()
+    
     with col1:
         st.markdown("### 📤 Upload Image")
         uploaded_file = st.file_uploader(
@@ -212,91 +430,75 @@ def main():
         )
         
         if uploaded_file is not None:
+            # Reject oversized uploads before any decode work
+            if uploaded_file.size > config.max_file_size_mb * 1024 * 1024:
+                st.error(f"❌ File exceeds the {config.max_file_size_mb} MB size limit.")
+                st.stop()
+            
+            # Canonicalize the upload once; reruns reuse the stored JPEG
+            try:
+                prepare_image(uploaded_file, config.max_image_dimension)
+            except OSError as e:
+                st.error(f"❌ Could not read this image: {str(e)}")
+                st.stop()
+            
             # Display uploaded image
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Image", use_container_width=True)
+            st.image(
+                st.session_state['_img_bytes_jpeg'],
+                caption="Uploaded Image",
+                use_container_width=True
+            )
             
             # Analyze button
             analyze_button = st.button("🔍 Detect Disease", type="primary", use_container_width=True)
             
-            if analyze_button:
+            # Set when the user overrides a negative quick check
+            skip_crop_check = (
+                st.session_state.pop('_skip_crop_check', None)
+                == st.session_state['_img_sha']
+            )
+            
+            if analyze_button or skip_crop_check:
                 with st.spinner("Analyzing image... Please wait. This may take a moment."):
                     try:
-                        # Get crop detection service
-                        crop_service = get_crop_service()
-                        
-                        # Read image bytes
-                        image_bytes = uploaded_file.getvalue()
-                        
-                        # Convert image to RGB if necessary and encode to base64
-                        pil_image = Image.open(io.BytesIO(image_bytes))
-                        if pil_image.mode != "RGB":
-                            pil_image = pil_image.convert("RGB")
-                        
-                        # Save to bytes buffer as JPEG
-                        buffer = io.BytesIO()
-                        pil_image.save(buffer, format="JPEG", quality=85)
-                        image_bytes = buffer.getvalue()
-                        
-                        # Encode to base64
-                        image_base64 = encode_image_to_base64(image_bytes)
-                        
-                        # Call crop detection service directly
-                        result = crop_service.detect_crop_disease(image_base64)
-                        
-                        # Convert Pydantic model to dict for display
-                        result_dict = result.model_dump()
+                        # Turn away non-crop images with a quick check
+                        # before requesting the full analysis
+                        if not skip_crop_check and not _cached_is_crop(
+                            st.session_state['_img_sha'],
+                            st.session_state['_img_b64']
+                        ):
+                            result_dict = {
+                                'is_crop_image': False,
+                                'analysis_summary': _QUICK_CHECK_SUMMARY,
+                                'quick_check': True
+                            }
+                        else:
+                            # Stream the analysis into the results column;
+                            # the service cache returns repeat images in
+                            # one step
+                            crop_service = get_crop_service()
+                            for result_dict in iter_async(
+                                crop_service.detect_crop_disease_stream(
+                                    st.session_state['_img_b64'],
+                                    st.session_state['_img_sha']
+                                )
+                            ):
+                                with results_placeholder.container():
+                                    _render_results(result_dict, partial=True)
                         
-                        # Store result in session state
+                        # Store the final result; rendered below
                         st.session_state['analysis_result'] = result_dict
                         st.success("✅ Analysis completed successfully!")
                         
-                        # Auto-scroll to results
-                        st.rerun()
-                        
                     except Exception as e:
                         st.error(f"❌ An error occurred: {str(e)}")
                         st.exception(e)
     
-    with col2:
-        st.markdown("### 📊 Analysis Results")
-        
+    # Render results once the upload column has run, so a fresh analysis
+    # shows up in the same script run without a rerun
+    with results_placeholder.container():
         if 'analysis_result' in st.session_state:
-            result = st.session_state['analysis_result']
-            
-            # Display analysis summary
-            if result.get('analysis_summary'):
-                st.markdown("### 📝 Analysis Summary")
-                st.info(result['analysis_summary'])
-            
-            # Check if image is crop-related
-            if not result.get('is_crop_image', False):
-                st.warning("⚠️ This image does not appear to contain crop-related content.")
-                if result.get('analysis_summary'):
-                    st.info(result['analysis_summary'])
-            else:
-                st.success("✅ Crop detected in image!")
-                
-                # Display crop information
-                if result.get('crop_info'):
-                    display_crop_info(result['crop_info'])
-                
-                # Display diseases
-                if result.get('diseases'):
-                    display_diseases(result['diseases'])
-                else:
-                    st.success("🎉 No diseases detected! Your crop appears healthy.")
-                
-                # Display recommendations
-                if result.get('recommendations'):
-                    display_recommendations(result['recommendations'])
-            
-            # Option to clear results
-            st.markdown("---")
-            if st.button("🔄 Clear Results"):
-                if 'analysis_result' in st.session_state:
-                    del st.session_state['analysis_result']
-                st.rerun()
+            _render_results(st.session_state['analysis_result'])
         else:
             st.info("👈 Upload an image and click 'Detect Disease' to see results here.")
     
@@ -0,0 +1,183 @@
+"""Tests for the asyncio micro-batcher."""
+import asyncio
+from micro_batcher import MicroBatcher
+
+
+def _make_batcher(batch_fn, single_fn, batch_timeout_seconds=1.0,
+                  max_batch_size=4):
+    """Build a batcher with a short collection window for tests."""
+    return MicroBatcher(
+        batch_fn=batch_fn,
+        single_fn=single_fn,
+        max_batch_size=max_batch_size,
+        window_seconds=0.05,
+        batch_timeout_seconds=batch_timeout_seconds
+    )
+
+
+async def _single(item):
+    return f"single:{item}"
+
+
+def test_batch_results_are_matched_by_position():
+    """Each waiter receives the batch result at its own position."""
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        return [f"batch:{item}" for item in items]
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, _single)
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(item) for item in ("a", "b", "c"))
+            )
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(scenario())
+
+    assert results == ["batch:a", "batch:b", "batch:c"]
+    assert batches == [["a", "b", "c"]]
+
+
+def test_batches_are_capped_at_max_batch_size():
+    """Items beyond max_batch_size go into a following batch."""
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        return [f"batch:{item}" for item in items]
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, _single, max_batch_size=2)
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(item) for item in ("a", "b", "c"))
+            )
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(scenario())
+
+    # The leftover item is sent on its own, which uses the single call
+    assert results == ["batch:a", "batch:b", "single:c"]
+    assert batches == [["a", "b"]]
+
+
+def test_batch_size_of_one_calls_single_fn_directly():
+    """Batching disabled means no batch call and no collection window."""
+    async def batch_fn(items):
+        raise AssertionError("batch_fn must not be called")
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, _single, max_batch_size=1)
+        try:
+            return await asyncio.gather(
+                batcher.submit("a"), batcher.submit("b")
+            )
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(scenario()) == ["single:a", "single:b"]
+
+
+def test_result_count_mismatch_falls_back_to_single_calls():
+    """A batch returning the wrong number of results is discarded."""
+    async def batch_fn(items):
+        return ["only one"]
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, _single)
+        try:
+            return await asyncio.gather(
+                batcher.submit("a"), batcher.submit("b")
+            )
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(scenario()) == ["single:a", "single:b"]
+
+
+def test_batch_timeout_falls_back_to_single_calls():
+    """A batch exceeding its time limit is cancelled and retried singly."""
+    cancelled = []
+
+    async def batch_fn(items):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return list(items)
+
+    async def scenario():
+        batcher = _make_batcher(
+            batch_fn, _single, batch_timeout_seconds=0.1
+        )
+        try:
+            return await asyncio.gather(
+                batcher.submit("a"), batcher.submit("b")
+            )
+        finally:
+            await batcher.close()
+
+    assert asyncio.run(scenario()) == ["single:a", "single:b"]
+    assert cancelled == [True]
+
+
+def test_single_call_errors_reach_only_their_waiter():
+    """A failing fallback call rejects its own waiter, not the others."""
+    async def batch_fn(items):
+        raise RuntimeError("batch failed")
+
+    async def single_fn(item):
+        if item == "bad":
+            raise ValueError("bad image")
+        return f"single:{item}"
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, single_fn)
+        try:
+            return await asyncio.gather(
+                batcher.submit("a"), batcher.submit("bad"),
+                return_exceptions=True
+            )
+        finally:
+            await batcher.close()
+
+    good, bad = asyncio.run(scenario())
+
+    assert good == "single:a"
+    assert isinstance(bad, ValueError)
+
+
+def test_cancelled_waiters_are_left_out_of_the_batch():
+    """Items whose caller gave up before dispatch are not sent."""
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        return [f"batch:{item}" for item in items]
+
+    async def scenario():
+        batcher = _make_batcher(batch_fn, _single)
+        try:
+            tasks = [
+                asyncio.ensure_future(batcher.submit(item))
+                for item in ("a", "b", "c")
+            ]
+            # Let every submission reach the queue, then cancel one
+            await asyncio.sleep(0.01)
+            tasks[1].cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await batcher.close()
+
+    first, second, third = asyncio.run(scenario())
+
+    assert first == "batch:a"
+    assert isinstance(second, asyncio.CancelledError)
+    assert third == "batch:c"
+    assert batches == [["a", "c"]]
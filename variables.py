@@ -1,37 +1,100 @@
 """Environment variables loading module."""
 import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import FrozenSet, Optional
 from dotenv import load_dotenv
-from logger_config import setup_logger
-
-# Load environment variables from .env file
-load_dotenv()
+from logger_config import set_console_level, setup_logger
 
 logger = setup_logger(__name__)
 
-# OpenAI Configuration
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-
-# API Configuration
-API_HOST = os.getenv("API_HOST", "127.0.0.1")
-API_PORT = int(os.getenv("API_PORT", "8000"))
-
-# File Upload Configuration
-MAX_FILE_SIZE_MB = int(os.getenv("MAX_FILE_SIZE_MB", "10"))
-ALLOWED_EXTENSIONS = os.getenv(
-    "ALLOWED_EXTENSIONS", "jpg,jpeg,png,webp"
-).split(",")
-
-# Validate required configuration
-if not OPENAI_API_KEY:
-    error_msg = "OPENAI_API_KEY is required but not set in environment"
-    logger.error(error_msg)
-    raise ValueError(error_msg)
-
-if not OPENAI_API_KEY.startswith("sk-"):
-    logger.warning(
-        "OPENAI_API_KEY does not start with 'sk-', "
-        "please verify it is correct"
+
+@dataclass(slots=True, frozen=True)
+class Config:
+    """Application configuration loaded from the environment."""
+
+    # Logging Configuration
+    log_level: str
+
+    # OpenAI Configuration
+    openai_api_key: Optional[str]
+    openai_model: str
+
+    # API Configuration
+    api_host: str
+    api_port: int
+
+    # File Upload Configuration
+    max_file_size_mb: int
+    max_image_dimension: int
+    allowed_extensions: FrozenSet[str]
+
+    # Response Cache Configuration
+    cache_mode: str
+    cache_max_entries: int
+    cache_ttl_seconds: int
+
+    # Request Batching Configuration
+    batch_max_size: int
+    batch_window_ms: int
+    batch_timeout_seconds: float
+
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """
+    Load application configuration from the environment.
+
+    The result is cached, so the .env file is read once per process.
+
+    Returns:
+        Application configuration.
+
+    Raises:
+        ValueError: If OPENAI_API_KEY is not set.
+    """
+    # Load environment variables from .env file
+    load_dotenv()
+
+    config = Config(
+        log_level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        openai_model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        api_host=os.getenv("API_HOST", "127.0.0.1"),
+        api_port=int(os.getenv("API_PORT", "8000")),
+        max_file_size_mb=int(os.getenv("MAX_FILE_SIZE_MB", "10")),
+        max_image_dimension=int(os.getenv("MAX_IMAGE_DIMENSION", "1024")),
+        allowed_extensions=frozenset(
+            ext.strip().lower().lstrip(".")
+            for ext in os.getenv(
+                "ALLOWED_EXTENSIONS", "jpg,jpeg,png,webp"
+            ).split(",")
+            if ext.strip()
+        ),
+        cache_mode=os.getenv("CACHE_MODE", "enabled").lower(),
+        cache_max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "10000")),
+        cache_ttl_seconds=int(os.getenv("CACHE_TTL_SECONDS", "86400")),
+        batch_max_size=int(os.getenv("BATCH_MAX_SIZE", "1")),
+        batch_window_ms=int(os.getenv("BATCH_WINDOW_MS", "50")),
+        batch_timeout_seconds=float(
+            os.getenv("BATCH_TIMEOUT_SECONDS", "60")
+        )
     )
 
-logger.info("Configuration loaded successfully")
+    # Apply a LOG_LEVEL set in the .env file to the console handler
+    set_console_level(config.log_level)
+
+    # Validate required configuration
+    if not config.openai_api_key:
+        error_msg = "OPENAI_API_KEY is required but not set in environment"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+    if not config.openai_api_key.startswith("sk-"):
+        logger.warning(
+            "OPENAI_API_KEY invalid prefix %r, please verify it is correct",
+            config.openai_api_key[:4]
+        )
+
+    logger.info("Configuration loaded successfully")
+    return config